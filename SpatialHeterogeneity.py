@@ -8,62 +8,192 @@
 # =============================================================================
 
 
+import os
+import functools
 import pandas as pd
-from geopy.distance import geodesic
+import numpy as np
+from sklearn.neighbors import BallTree
 from Classification import classidication, read_csv
+from joblib import Parallel, delayed
 import csv
 
+
+@functools.lru_cache(maxsize=None)
+def classify_window(No, start, end):
+    """
+        Classifies a station's trend over a given common period.
+
+        Each unordered pair (a, b) is visited twice — once with either
+        station as the centre — and neighbouring pairs often share the same
+        overlap window, so the classification is memoised on the station
+        and window rather than recomputed per pair.
+
+        Args:
+            No (str): The station number.
+            start (pd.Timestamp): The first year of the common period.
+            end (pd.Timestamp): The last year of the common period.
+
+        Returns:
+            tuple: The classidication() result for the trimmed series.
+    """
+    GWL = read_csv(No)
+    GWL = GWL.iloc[GWL.index.searchsorted(start):GWL.index.searchsorted(end, side='right')]
+    return classidication(GWL)
+
+
+@functools.lru_cache(maxsize=None)
+def series_meta(No):
+    """
+        Returns the annual index of a station's series with its endpoints.
+
+        The pair loop only needs the time axis to find the common period
+        and count the overlapping years; caching it per station means the
+        reject path never constructs a frame at all.
+
+        Args:
+            No (str): The station number.
+
+        Returns:
+            tuple: (index, first timestamp, last timestamp) of the series.
+    """
+    index = read_csv(No).index
+    return index, index[0], index[-1]
+
+
+def process_group(nos, coords):
+    """
+        Runs the 15 km consistency comparison for one aquifer group.
+
+        The consistency label is symmetric in the two stations, so each
+        unordered pair is evaluated once — neighbours with a higher index
+        than the centre — and the result is credited to both stations'
+        tallies, halving the classification work. The group is the parallel
+        unit because the shared tallies must live in one worker.
+
+        Args:
+            nos (array): The group's station numbers.
+            coords (array): The group's (lat, long) coordinates in radians.
+
+        Returns:
+            list: One output row [No, pairs compared, consistent,
+                  inconsistent] per station, in group order.
+    """
+    tree = BallTree(coords, metric='haversine')
+    # Select points with distance less than X km, for all centres at once
+    neighbour_lists = tree.query_radius(coords, r=15 / 6371.0)
+
+    # The group's time axes and record endpoints, gathered once so the
+    # per-centre qualification below runs on plain arrays.
+    metas = [series_meta(no) for no in nos]
+    firsts = np.array([first for _, first, _ in metas], dtype='datetime64[ns]')
+    lasts = np.array([last for _, _, last in metas], dtype='datetime64[ns]')
+
+    n_cons = np.zeros(len(nos), dtype=int)
+    n_incons = np.zeros(len(nos), dtype=int)
+    for i, nbrs in enumerate(neighbour_lists):
+        cand = nbrs[nbrs > i]
+        if len(cand) == 0:
+            continue
+
+        # Analyze the Common Time Period for every candidate pair at once:
+        # the window endpoints are elementwise bound comparisons, and the
+        # centre's year count inside each window is one batched binary
+        # search on its cached index. Candidates where the centre falls
+        # short never reach the Python loop below.
+        idx_1 = metas[i][0]
+        starts = np.maximum(firsts[i], firsts[cand])
+        ends = np.minimum(lasts[i], lasts[cand])
+        n_1 = idx_1.searchsorted(ends, side='right') - idx_1.searchsorted(starts)
+        qualified = n_1 > 8
+        cand, starts, ends = cand[qualified], starts[qualified], ends[qualified]
+
+        for j, start, end in zip(cand, starts, ends):
+            # Ensure there are enough years in the common period for a meaningful comparison
+            idx_2 = metas[j][0]
+            n_2 = idx_2.searchsorted(end, side='right') - idx_2.searchsorted(start)
+            if n_2 > 8:
+                # Determine Trend Consistency
+                start, end = pd.Timestamp(start), pd.Timestamp(end)
+                Trend_1, ts_s_1, pw_R2_1, windows_1, start_year_1, end_year_1 = classify_window(
+                    nos[i], start, end)
+                Trend_2, ts_s_2, pw_R2_2, windows_2, start_year_2, end_year_2 = classify_window(
+                    nos[j], start, end)
+                if Trend_1 == 'No trend' or Trend_2 == 'No trend' or ts_s_1 / ts_s_2 > 0:
+                    n_cons[i] += 1
+                    n_cons[j] += 1
+                else:
+                    n_incons[i] += 1
+                    n_incons[j] += 1
+    return [[nos[i], int(n_cons[i] + n_incons[i]), int(n_cons[i]), int(n_incons[i])]
+            for i in range(len(nos))]
+
+
+def load_stations():
+    """
+        Loads the qualified long-trend stations from the station summary.
+
+        The summary is converted to Parquet on first use; subsequent loads
+        push the column selection and the qualification predicates (more
+        than 8 years of record, Increasing or Decreasing trend) down into
+        the Parquet reader, so rejected rows are never materialised.
+
+        Returns:
+            pd.DataFrame: The filtered station metadata.
+    """
+    # Rebuild the snapshot whenever the summary CSV is newer, so reruns
+    # after a fresh download/classification pass never read stale rows.
+    if (not os.path.exists('stations_info.parquet')
+            or os.path.getmtime('stations_info.parquet') < os.path.getmtime("stations info.csv")):
+        pd.read_csv("stations info.csv").to_parquet('stations_info.parquet')
+    stations = pd.read_parquet(
+        'stations_info.parquet',
+        columns=['No', 'lat', 'long', 'Revised aquifers'],
+        filters=[('total year', '>', 8), ('classification', 'in', ['Increasing', 'Decreasing'])])
+    # Compact dtypes: float32 is plenty for coordinates feeding a 15 km
+    # radius query, int32 covers the station numbers, and categorical
+    # aquifers group on small integer codes instead of strings.
+    stations = stations.astype({'No': 'int32', 'lat': 'float32', 'long': 'float32'})
+    # Blank aquifer fields behave like unallocated stations: they can
+    # never match a neighbour's aquifer, so fold them into that group
+    # rather than letting groupby drop their rows from the output.
+    stations['Revised aquifers'] = (stations['Revised aquifers']
+                                    .fillna('Unallocated to aquifers').astype('category'))
+    return stations
+
+
 if __name__ == '__main__':
     # Load and Filter Initial Station Data
-    data = pd.read_csv("stations info.csv")
-    data = data[(data['total year'] > 8) & ((data['classification'] == 'Increasing') | (
-                data['classification'] == 'Decreasing'))].reset_index().drop(['index'], axis=1)
-    No = data['No']
-    lat = data['lat']
-    long = data['long']
-    trend = data['classification']
-
-    # Set up the Output CSV File
-    with open('15km_consistency.csv', 'a', newline='') as csvfile:
+    data = load_stations()
+    # Set up the Output CSV File. Write mode keeps reruns from stacking
+    # duplicate headers and stale rows; finished rows are buffered and
+    # flushed in batches rather than written one syscall at a time.
+    with open('15km_consistency.csv', 'w', newline='', buffering=1 << 20) as csvfile:
         csv_writer = csv.writer(csvfile)
         csv_writer.writerow(['No', 'Num of station', 'Num of consistent', 'Num of inconsistent'])
+        out_rows = []
+
+        # Stations can only ever be compared with neighbours in the same
+        # aquifer, so each aquifer group gets its own spatial index:
+        # candidate sets shrink to same-aquifer stations and the per-pair
+        # aquifer equality check disappears from the inner loop. The
+        # spherical BallTree metric is well within tolerance at 15 km.
+        allocated = []
+        for aquifer, sub in data.groupby('Revised aquifers'):
+            # Stations without an aquifer never form a comparable pair;
+            # report their empty neighbourhoods without building an index.
+            if aquifer == 'Unallocated to aquifers':
+                out_rows.extend([no, 0, 0, 0] for no in sub['No'])
+            else:
+                allocated.append((sub['No'].to_numpy(),
+                                  np.radians(sub[['lat', 'long']].to_numpy())))
 
-        # Iterate Through Each Qualified Station
-        for i in range(len(No)):
-            print(i)
-
-            # Find and Analyze Neighboring Stations
-            ini_select = data[(data['No'] != No[i]) & (data['lat'] > lat[i] - 0.15) & (data['lat'] < lat[i] + 0.15) &
-                              (data['long'] > long[i] - 0.25) & (data['long'] < long[i] + 0.25)].reset_index().drop(
-                ['index'], axis=1)
-            consistency = []
-            for j in range(len(ini_select)):
-                GWL_1 = read_csv(No[i])
-
-                # Calculate the distance between the centre point and other points
-                distance_km = geodesic((lat[i], long[i]), (ini_select['lat'][j], ini_select['long'][j])).kilometers
-
-                # Select points with distance less than X km
-                if distance_km <= 15:
-                    if data['Revised aquifers'][i] != 'Unallocated to aquifers' and data['Revised aquifers'][i] == \
-                            ini_select['Revised aquifers'][j]:  # 'same aquifers'
-                        GWL_2 = read_csv(ini_select['No'][j])
-
-                        # Analyze the Common Time Period
-                        start = max([GWL_1.index[0], GWL_2.index[0]])
-                        end = min([GWL_1.index[-1], GWL_2.index[-1]])
-                        GWL_1 = GWL_1[(GWL_1.index >= start) & (GWL_1.index <= end)]
-                        GWL_2 = GWL_2[(GWL_2.index >= start) & (GWL_2.index <= end)]
-
-                        # Ensure there are enough years in the common period for a meaningful comparison
-                        if len(GWL_1) > 8 and len(GWL_2) > 8:
-                            # Determine Trend Consistency
-                            Trend_1, ts_s_1, pw_R2_1, windows_1, start_year_1, end_year_1 = classidication(GWL_1)
-                            Trend_2, ts_s_2, pw_R2_2, windows_2, start_year_2, end_year_2 = classidication(GWL_2)
-                            if Trend_1 == 'No trend' or Trend_2 == 'No trend' or ts_s_1[0]/ts_s_2[0] > 0:
-                                label = 'consistent'
-                            else:
-                                label = 'inconsistent'
-                            consistency.append(label)
-            csv_writer.writerow(
-                [No[i], len(consistency), consistency.count('consistent'), consistency.count('inconsistent')])
+        # Aquifer groups are independent, so they form the parallel unit;
+        # pair deduplication keeps each group's shared tallies in one worker.
+        results = Parallel(n_jobs=-1, backend='loky', verbose=5)(
+            delayed(process_group)(nos, coords) for nos, coords in allocated)
+        for rows in results:
+            out_rows.extend(rows)
+            if len(out_rows) >= 1024:
+                csv_writer.writerows(out_rows)
+                out_rows.clear()
+        csv_writer.writerows(out_rows)